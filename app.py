@@ -9,6 +9,11 @@ from eks.myapp import MyappStack
 
 
 app = cdk.App()
-EksStack(app, "EksStack")
+EksStack(
+    app,
+    "EksStack",
+    image_cache_snapshot_id=os.getenv("IMAGE_CACHE_SNAPSHOT_ID"),
+    node_local_dns=os.getenv("NODE_LOCAL_DNS", "false").lower() == "true",
+)
 MyappStack(app, "myapps-docker", env=cdk.Environment(account=os.getenv('CDK_DEFAULT_ACCOUNT'), region=os.getenv('CDK_DEFAULT_REGION')))
 app.synth()
@@ -1,4 +1,6 @@
+import json
 from pathlib import Path
+from typing import Optional
 import yaml
 import aws_cdk as cdk
 from constructs import Construct
@@ -13,6 +15,38 @@ from aws_cdk import (
 )
 from aws_cdk.lambda_layer_kubectl_v32 import KubectlV32Layer
 
+# Keep in sync with manifests/node-local-dns.yaml and the clusterDNS comment in
+# helm_values/karpenter-provisioner.yaml.
+NODE_LOCAL_DNS_IP = "169.254.20.10"
+
+# Kernel modules kube-proxy needs in IPVS mode.
+IPVS_KERNEL_MODULES = ["ip_vs", "ip_vs_rr", "ip_vs_wrr", "ip_vs_sh", "nf_conntrack"]
+
+COREDNS_COREFILE = """.:53 {
+    errors
+    health {
+        lameduck 5s
+    }
+    ready
+    kubernetes cluster.local in-addr.arpa ip6.arpa {
+        pods insecure
+        fallthrough in-addr.arpa ip6.arpa
+    }
+    prometheus :9153
+    forward . /etc/resolv.conf {
+        max_concurrent 1000
+    }
+    cache 300 {
+        success 65536 300
+        denial 8192 5
+        prefetch 10 1m 10%
+    }
+    loop
+    reload
+    loadbalance
+}
+"""
+
 
 class EksStack(cdk.Stack):
     """Create an EKS cluster that's bootstrapped with some helmcharts:
@@ -22,11 +56,48 @@ class EksStack(cdk.Stack):
 
     Args:
         cdk (_type_): _description_
+        max_parallel_image_pulls (int): number of images kubelet pulls in parallel.
+        kube_reserved (dict, optional): kubelet kubeReserved, e.g. {"cpu": "100m"}.
+            Defaults to the values nodeadm calculates for the instance type.
+        system_reserved (dict, optional): kubelet systemReserved, e.g. {"memory": "256Mi"}.
+            Defaults to the values nodeadm calculates for the instance type.
+        root_volume_size (int): size of the gp3 root volume of the nodegroup in GiB.
+        root_volume_throughput (int): provisioned throughput in MiB/s of the root and
+            image cache volumes, between 125 and 1000. IOPS are raised to match.
+        image_cache_snapshot_id (str, optional): EBS snapshot with a prebuilt containerd
+            image cache, restored as a data volume mounted at /var/lib/containerd.
+            Enable fast snapshot restore on it in every AZ of the VPC, otherwise
+            blocks are lazily loaded from S3 and the first reads are slower than a
+            registry pull.
+        node_local_dns (bool): deploy NodeLocal DNSCache and point kubelet at it. The
+            cache daemonset is applied before the nodegroup and the helm charts, but on
+            nodes added later, and while the daemonset rolls out, pods have no DNS until
+            the node-local-dns pod on their node is ready.
     """
 
-    def __init__(self, scope: Construct, id: str, **kwargs) -> None:
+    def __init__(
+        self,
+        scope: Construct,
+        id: str,
+        *,
+        max_parallel_image_pulls: int = 5,
+        kube_reserved: Optional[dict] = None,
+        system_reserved: Optional[dict] = None,
+        root_volume_size: int = 50,
+        root_volume_throughput: int = 250,
+        image_cache_snapshot_id: Optional[str] = None,
+        node_local_dns: bool = False,
+        **kwargs,
+    ) -> None:
         super().__init__(scope, id, **kwargs)
 
+        if not 125 <= root_volume_throughput <= 1000:
+            raise ValueError(
+                f"root_volume_throughput must be between 125 and 1000 MiB/s, got {root_volume_throughput}"
+            )
+        # gp3 allows at most 0.25 MiB/s of throughput per provisioned IOPS.
+        node_volume_iops = max(3000, root_volume_throughput * 4)
+
         # Create VPC with 2 public and 2 private subnets
         nat_gateway_provider = ec2.NatProvider.instance_v2(
             instance_type=ec2.InstanceType.of(
@@ -97,90 +168,6 @@ class EksStack(cdk.Stack):
             ],
         )
 
-        eks.KubernetesPatch(
-            self,
-            "EnablePrefixDelegation",
-            cluster=cluster,
-            resource_name="daemonset/aws-node",
-            resource_namespace="kube-system",
-            apply_patch={
-                "spec": {
-                    "template": {
-                        "spec": {
-                            "containers": [
-                                {
-                                    "name": "aws-node",
-                                    "env": [
-                                        {
-                                            "name": "ENABLE_PREFIX_DELEGATION",
-                                            "value": "true",
-                                        }
-                                    ],
-                                }
-                            ],
-                        },
-                    },
-                },
-            },
-            restore_patch={},
-        )
-
-        eks.KubernetesPatch(
-            self,
-            "MinWarmIPAddr",
-            cluster=cluster,
-            resource_name="daemonset/aws-node",
-            resource_namespace="kube-system",
-            apply_patch={
-                "spec": {
-                    "template": {
-                        "spec": {
-                            "containers": [
-                                {
-                                    "name": "aws-node",
-                                    "env": [
-                                        {
-                                            "name": "MINIMUM_IP_TARGET",
-                                            "value": "1",
-                                        }
-                                    ],
-                                }
-                            ],
-                        },
-                    },
-                },
-            },
-            restore_patch={},
-        )
-
-        eks.KubernetesPatch(
-            self,
-            "WarmIPAddr",
-            cluster=cluster,
-            resource_name="daemonset/aws-node",
-            resource_namespace="kube-system",
-            apply_patch={
-                "spec": {
-                    "template": {
-                        "spec": {
-                            "containers": [
-                                {
-                                    "name": "aws-node",
-                                    "env": [
-                                        {
-                                            "name": "WARM_IP_TARGET",
-                                            "value": "1",
-                                        }
-                                    ],
-                                }
-                            ],
-                        },
-                    },
-                },
-            },
-            restore_patch={},
-        )
-
         access_entry1 = eks.AccessPolicy.from_access_policy_name(
             "AmazonEKSClusterAdminPolicy", access_scope_type=eks.AccessScopeType.CLUSTER
         )
@@ -212,6 +199,107 @@ class EksStack(cdk.Stack):
             iam.ManagedPolicy.from_aws_managed_policy_name("AmazonEKS_CNI_Policy")
         )
 
+        # nodeadm configuration merged by EKS into the AL2023 bootstrap. Pull images
+        # in parallel and optionally override the reserved resources.
+        node_config = {
+            "apiVersion": "node.eks.aws/v1alpha1",
+            "kind": "NodeConfig",
+            "spec": {
+                "kubelet": {
+                    "config": {
+                        "serializeImagePulls": False,
+                        "maxParallelImagePulls": max_parallel_image_pulls,
+                    },
+                },
+            },
+        }
+        if kube_reserved:
+            node_config["spec"]["kubelet"]["config"]["kubeReserved"] = kube_reserved
+        if system_reserved:
+            node_config["spec"]["kubelet"]["config"]["systemReserved"] = system_reserved
+        if node_local_dns:
+            # kube-proxy runs in IPVS mode, so pods must query the node cache directly.
+            node_config["spec"]["kubelet"]["config"]["clusterDNS"] = [NODE_LOCAL_DNS_IP]
+        node_user_data = ec2.MultipartUserData()
+        node_user_data.add_part(
+            ec2.MultipartBody.from_raw_body(
+                content_type="application/node.eks.aws",
+                body=yaml.safe_dump(node_config, sort_keys=False),
+            )
+        )
+        # kube-proxy runs in IPVS mode, load its kernel modules on every boot.
+        node_user_data.add_part(
+            ec2.MultipartBody.from_raw_body(
+                content_type='text/x-shellscript; charset="us-ascii"',
+                body="\n".join(
+                    [
+                        "#!/bin/bash",
+                        "set -euo pipefail",
+                        f"printf '%s\\n' {' '.join(IPVS_KERNEL_MODULES)} > /etc/modules-load.d/ipvs.conf",
+                        f"for module in {' '.join(IPVS_KERNEL_MODULES)}; do modprobe $module; done",
+                    ]
+                ),
+            )
+        )
+
+        block_device_mappings = [
+            ec2.CfnLaunchTemplate.BlockDeviceMappingProperty(
+                device_name="/dev/xvda",
+                ebs=ec2.CfnLaunchTemplate.EbsProperty(
+                    volume_size=root_volume_size,
+                    volume_type="gp3",
+                    iops=node_volume_iops,
+                    throughput=root_volume_throughput,
+                    encrypted=True,
+                    delete_on_termination=True,
+                ),
+            )
+        ]
+        if image_cache_snapshot_id:
+            # Data volume with pre-pulled images, mounted before nodeadm starts containerd.
+            # If the device never shows up the node boots without the cache.
+            block_device_mappings.append(
+                ec2.CfnLaunchTemplate.BlockDeviceMappingProperty(
+                    device_name="/dev/xvdb",
+                    ebs=ec2.CfnLaunchTemplate.EbsProperty(
+                        snapshot_id=image_cache_snapshot_id,
+                        volume_type="gp3",
+                        iops=node_volume_iops,
+                        throughput=root_volume_throughput,
+                        encrypted=True,
+                        delete_on_termination=True,
+                    ),
+                )
+            )
+            node_user_data.add_part(
+                ec2.MultipartBody.from_raw_body(
+                    content_type='text/x-shellscript; charset="us-ascii"',
+                    body="\n".join(
+                        [
+                            "#!/bin/bash",
+                            "set -euo pipefail",
+                            "for i in $(seq 120); do [ -e /dev/xvdb ] && break; sleep 1; done",
+                            "if [ ! -e /dev/xvdb ]; then",
+                            "  echo 'image cache volume /dev/xvdb not attached after 120s, skipping mount' | systemd-cat -t image-cache -p err",
+                            "  exit 1",
+                            "fi",
+                            "mkdir -p /var/lib/containerd",
+                            "mount /dev/xvdb /var/lib/containerd",
+                            "echo '/dev/xvdb /var/lib/containerd auto defaults,nofail 0 2' >> /etc/fstab",
+                        ]
+                    ),
+                )
+            )
+
+        node_launch_template = ec2.CfnLaunchTemplate(
+            self,
+            "NodeLaunchTemplate",
+            launch_template_data=ec2.CfnLaunchTemplate.LaunchTemplateDataProperty(
+                block_device_mappings=block_device_mappings,
+                user_data=cdk.Fn.base64(node_user_data.render()),
+            ),
+        )
+
         cluster_nodegroup = cluster.add_nodegroup_capacity(
             "prefix-ng-spot",
             instance_types=[
@@ -223,9 +311,14 @@ class EksStack(cdk.Stack):
             ami_type=eks.NodegroupAmiType.AL2023_X86_64_STANDARD,
             labels={"role": "prefix-ng-spot"},
             capacity_type=eks.CapacityType.SPOT,
-            disk_size=20,
+            # disk size is set by the launch template root volume. Moving from disk_size
+            # to a launch template replaces the nodegroup, so the name is left to
+            # CloudFormation to let the replacement be created next to the old one.
+            launch_template_spec=eks.LaunchTemplateSpec(
+                id=node_launch_template.ref,
+                version=node_launch_template.attr_latest_version_number,
+            ),
             # node_role=custom_nodegroup_role,
-            nodegroup_name="prefix-ng-spot",
         )
 
         # cluster.aws_auth.add_user_mapping(cluster_admin_role, groups=["system:masters"])
@@ -272,6 +365,80 @@ class EksStack(cdk.Stack):
             ],
         )
 
+        # Networking addons, pinned and configured through the addon instead of patching
+        # the self-managed daemonsets.
+        eks.CfnAddon(
+            self,
+            "VpcCniAddon",
+            addon_name="vpc-cni",
+            addon_version="v1.19.2-eksbuild.5",
+            cluster_name=cluster.cluster_name,
+            preserve_on_delete=False,
+            resolve_conflicts="OVERWRITE",
+            configuration_values=json.dumps(
+                {
+                    "env": {
+                        "ENABLE_PREFIX_DELEGATION": "true",
+                        "MINIMUM_IP_TARGET": "1",
+                        "WARM_IP_TARGET": "1",
+                    }
+                }
+            ),
+        )
+
+        kube_proxy_addon = eks.CfnAddon(
+            self,
+            "KubeProxyAddon",
+            addon_name="kube-proxy",
+            addon_version="v1.32.0-eksbuild.2",
+            cluster_name=cluster.cluster_name,
+            preserve_on_delete=False,
+            resolve_conflicts="OVERWRITE",
+            configuration_values=json.dumps(
+                {"mode": "ipvs", "ipvs": {"scheduler": "rr"}}
+            ),
+        )
+
+        coredns_addon = eks.CfnAddon(
+            self,
+            "CoreDnsAddon",
+            addon_name="coredns",
+            addon_version="v1.11.4-eksbuild.2",
+            cluster_name=cluster.cluster_name,
+            preserve_on_delete=False,
+            resolve_conflicts="OVERWRITE",
+            configuration_values=json.dumps(
+                {
+                    "autoScaling": {
+                        "enabled": True,
+                        "minReplicas": 2,
+                        "maxReplicas": 10,
+                    },
+                    "corefile": COREDNS_COREFILE,
+                }
+            ),
+        )
+        # coredns only becomes active once there are nodes to schedule on.
+        coredns_addon.node.add_dependency(cluster_nodegroup)
+
+        if node_local_dns:
+            node_local_dns_manifest: Path = (
+                Path(__file__).resolve().parents[1] / "manifests/node-local-dns.yaml"
+            )
+            assert node_local_dns_manifest.exists()
+            node_local_dns_cache = cluster.add_manifest(
+                "NodeLocalDns",
+                *[
+                    doc
+                    for doc in yaml.safe_load_all(node_local_dns_manifest.read_text())
+                    if doc
+                ],
+            )
+            # Nodes boot with clusterDNS pointing at the cache, so the daemonset has
+            # to exist before the nodegroup rolls.
+            node_local_dns_cache.node.add_dependency(kube_proxy_addon)
+            cluster_nodegroup.node.add_dependency(node_local_dns_cache)
+
         # Add karpenter service account
         karpenter_sa = cluster.add_service_account(
             "karpenter",
@@ -475,7 +642,7 @@ class EksStack(cdk.Stack):
         )
 
         # karpenter helm chart.
-        cluster.add_helm_chart(
+        karpenter_helm = cluster.add_helm_chart(
             "karpenter",
             chart="karpenter",
             repository="oci://public.ecr.aws/karpenter/karpenter",
@@ -567,6 +734,15 @@ class EksStack(cdk.Stack):
         argocd_image_updater.node.add_dependency(argocd_helm)
         service_account_argo_image_updater.node.add_dependency(argocd_helm)
 
+        if node_local_dns:
+            for workload in [
+                karpenter_helm,
+                argocd_helm,
+                argocd_image_updater,
+                cluster.alb_controller,
+            ]:
+                workload.node.add_dependency(node_local_dns_cache)
+
         cdk.CfnOutput(self, "cluster-name", value=cluster.cluster_name)
 
         cdk.CfnOutput(
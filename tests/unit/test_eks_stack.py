@@ -1,5 +1,9 @@
+import base64
+import json
+
 import aws_cdk as core
 import aws_cdk.assertions as assertions
+import pytest
 
 from eks.eks_stack import EksStack
 
@@ -13,3 +17,122 @@ def test_sqs_queue_created():
 #     template.has_resource_properties("AWS::SQS::Queue", {
 #         "VisibilityTimeout": 300
 #     })
+
+
+def _node_user_data(template):
+    launch_templates = template.find_resources("AWS::EC2::LaunchTemplate")
+    [user_data] = [
+        resource["Properties"]["LaunchTemplateData"]["UserData"]
+        for logical_id, resource in launch_templates.items()
+        if logical_id.startswith("NodeLaunchTemplate")
+    ]
+    if isinstance(user_data, dict):
+        return user_data["Fn::Base64"]
+    return base64.b64decode(user_data).decode()
+
+
+def _node_local_dns_manifests(template):
+    return [
+        logical_id
+        for logical_id, resource in template.find_resources(
+            "Custom::AWSCDK-EKS-KubernetesResource"
+        ).items()
+        if "node-local-dns" in json.dumps(resource["Properties"])
+    ]
+
+
+def test_nodegroup_launch_template():
+    app = core.App()
+    stack = EksStack(app, "eks", image_cache_snapshot_id="snap-0123456789abcdef0")
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::EC2::LaunchTemplate", {
+        "LaunchTemplateData": {
+            "BlockDeviceMappings": [
+                {"DeviceName": "/dev/xvda", "Ebs": assertions.Match.object_like({"VolumeType": "gp3", "Throughput": 250})},
+                {"DeviceName": "/dev/xvdb", "Ebs": assertions.Match.object_like({"SnapshotId": "snap-0123456789abcdef0"})},
+            ],
+        },
+    })
+    template.has_resource_properties("AWS::EKS::Nodegroup", {
+        "NodegroupName": assertions.Match.absent(),
+        "DiskSize": assertions.Match.absent(),
+        "LaunchTemplate": assertions.Match.object_like({}),
+    })
+
+    user_data = _node_user_data(template)
+    assert "Content-Type: application/node.eks.aws" in user_data
+    assert "serializeImagePulls: false" in user_data
+    assert "maxParallelImagePulls: 5" in user_data
+    assert "kubeReserved" not in user_data
+    assert "systemReserved" not in user_data
+    assert "mount /dev/xvdb /var/lib/containerd" in user_data
+
+
+def test_nodegroup_reserved_resources():
+    app = core.App()
+    stack = EksStack(
+        app,
+        "eks",
+        max_parallel_image_pulls=10,
+        kube_reserved={"memory": "1Gi"},
+        system_reserved={"cpu": "200m"},
+        root_volume_throughput=1000,
+    )
+    template = assertions.Template.from_stack(stack)
+
+    user_data = _node_user_data(template)
+    assert "maxParallelImagePulls: 10" in user_data
+    assert "kubeReserved:\n        memory: 1Gi" in user_data
+    assert "systemReserved:\n        cpu: 200m" in user_data
+    assert "/dev/xvdb" not in user_data
+    template.has_resource_properties("AWS::EC2::LaunchTemplate", {
+        "LaunchTemplateData": {
+            "BlockDeviceMappings": [
+                {"DeviceName": "/dev/xvda", "Ebs": assertions.Match.object_like({"Throughput": 1000, "Iops": 4000})},
+            ],
+        },
+    })
+
+
+def test_root_volume_throughput_validated():
+    app = core.App()
+    with pytest.raises(ValueError):
+        EksStack(app, "eks", root_volume_throughput=2000)
+
+
+def test_networking_addons():
+    app = core.App()
+    stack = EksStack(app, "eks", node_local_dns=True)
+    template = assertions.Template.from_stack(stack)
+
+    for addon_name in ["vpc-cni", "coredns", "kube-proxy"]:
+        template.has_resource_properties("AWS::EKS::Addon", {
+            "AddonName": addon_name,
+            "ConfigurationValues": assertions.Match.any_value(),
+        })
+    template.has_resource_properties("AWS::EKS::Addon", {
+        "AddonName": "kube-proxy",
+        "ConfigurationValues": assertions.Match.serialized_json({"mode": "ipvs", "ipvs": {"scheduler": "rr"}}),
+    })
+    [node_local_dns] = _node_local_dns_manifests(template)
+    assert "clusterDNS:\n      - 169.254.20.10" in _node_user_data(template)
+    assert "modprobe" in _node_user_data(template)
+
+    for nodegroup in template.find_resources("AWS::EKS::Nodegroup").values():
+        assert node_local_dns in nodegroup["DependsOn"]
+    charts = {
+        resource["Properties"]["Chart"]: resource
+        for resource in template.find_resources("Custom::AWSCDK-EKS-HelmChart").values()
+    }
+    for chart in ["karpenter", "argo-cd", "argocd-image-updater", "aws-load-balancer-controller"]:
+        assert node_local_dns in charts[chart]["DependsOn"]
+
+
+def test_node_local_dns_disabled():
+    app = core.App()
+    stack = EksStack(app, "eks")
+    template = assertions.Template.from_stack(stack)
+
+    assert _node_local_dns_manifests(template) == []
+    assert "clusterDNS" not in _node_user_data(template)